@@ -1,38 +1,87 @@
-import json
-from typing import List, Dict, Any
+import asyncio
+import hashlib
+import io
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional, Tuple
 import cv2
+import httpx
 import numpy as np
 import openai
+import orjson
 import uvicorn
-from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException
+from cachetools import LRUCache
+from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, Request
+from fastapi.responses import ORJSONResponse
+from starlette.datastructures import Headers
 import os
 
+from sqlalchemy import case, func
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 
 from clip_classifier import ClipImageClassifier
-from db import get_db, TemplateModel, Template, TextFieldModel
-from helpers import build_truncation_prompt, build_extraction_prompt
+from db import get_db, TemplateModel, Template, TextFieldModel, UrlSelectionRequest
+from helpers import build_truncation_prompt, build_extraction_prompt, build_extraction_schema
 
-app = FastAPI()
-openai_client = openai.OpenAI(api_key=os.getenv("OPENAI_KEY"))
+# One pooled HTTP/2 client shared by every OpenAI call for the lifetime of the process
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=60,
+)
+openai_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_KEY"), http_client=http_client)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await http_client.aclose()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 clip = ClipImageClassifier()
 
+# (label, score) per image, keyed by SHA-1 of the raw upload bytes
+classification_cache: LRUCache = LRUCache(maxsize=10_000)
+
+# Structured-output response formats per template; templates are never modified after upload
+extraction_formats: Dict[Tuple[int, str], Dict[str, Any]] = {}
+
+# Caps concurrent truncation calls to stay within the OpenAI rate limit
+truncation_semaphore = asyncio.Semaphore(8)
 
-def truncate_text_if_needed(text: str, target_max_length: int, current_iteration: int = 1):
-    """Truncate a text string using llm if it's too long."""
-    if len(text) > target_max_length and current_iteration < 4:
-        completion = openai_client.chat.completions.create(
+
+async def _llm_shrink(text: str) -> str:
+    """Ask the llm for a shorter version of a text string."""
+    async with truncation_semaphore:
+        completion = await openai_client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": build_truncation_prompt(
                 text
             )}],
             temperature=0.3,
         )
-        gpt_result = completion.choices[0].message.content.strip()
-        return truncate_text_if_needed(gpt_result, target_max_length, current_iteration+1)
-    else:
+    return completion.choices[0].message.content.strip()
+
+
+async def truncate_text_if_needed(text: str, target_max_length: int, max_iterations: int = 2) -> str:
+    """Truncate a text string using llm if it's too long, then hard-cut at a word boundary if still over."""
+    for _ in range(max_iterations):
+        if len(text) <= target_max_length:
+            return text
+        text = await _llm_shrink(text)
+
+    if len(text) <= target_max_length:
         return text
+    return text[:target_max_length - 1].rsplit(" ", 1)[0].rstrip() + "…"
+
+
+def decode_image(raw: bytes) -> np.ndarray:
+    """Decode uploaded image bytes into a BGR array."""
+    img_np = cv2.imdecode(np.frombuffer(raw, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img_np is None:
+        raise ValueError("could not decode image")
+    return img_np
 
 
 @app.post("/upload-template/")
@@ -42,7 +91,7 @@ async def upload_template(
 ):
     raw = await metadata.read()
     try:
-        payload = json.loads(raw)
+        payload = orjson.loads(raw)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
 
@@ -53,11 +102,32 @@ async def upload_template(
     duplicates = 0
     errors: List[Dict[str, Any]] = []
 
+    # Look up already-stored names once instead of relying on per-row IntegrityError rollbacks
+    names = [
+        obj["template_name"] for obj in payload
+        if isinstance(obj, dict) and isinstance(obj.get("template_name"), str)
+    ]
+    seen_names = {
+        name for (name,) in
+        db.query(TemplateModel.template_name).filter(TemplateModel.template_name.in_(names)).all()
+    }
+
+    templates: List[TemplateModel] = []
+    template_children: List[List[Dict[str, Any]]] = []
+
     for i, obj in enumerate(payload):
         try:
             # 1) Validate strictly with Pydantic
             t = Template(**obj)
 
+            if t.template_name in seen_names:
+                duplicates += 1
+                errors.append({
+                    "index": i, "template_name": t.template_name, "error": "duplicate",
+                    "detail": "template_name already exists",
+                })
+                continue
+
             # 2) Compute counts
             realtor = t.realtor or None
             logos = t.logos or []
@@ -70,55 +140,59 @@ async def upload_template(
             realtor_texts = sum(1 for v in (realtor_name, realtor_info) if v)
             text_count = len(t.text_fields) + realtor_texts
 
-            # 3) Create parent row
-            db_template = TemplateModel(
+            realtor_photo = (realtor.photo.strip() if (realtor and realtor.photo) else None) if realtor else None
+
+            # 3) Text fields (children), inserted once parent ids are known
+            children = []
+            for name, spec in t.text_fields.items():
+                # enforce clean key
+                key = name.strip()
+                if not key:
+                    continue
+                children.append({
+                    "name": key,
+                    "approx_length": spec.approx_length,
+                    "format": spec.format.strip(),
+                })
+
+            # 4) Parent row
+            templates.append(TemplateModel(
                 template_name=t.template_name,
                 output=t.output,
                 realtor_name=realtor_name,
                 realtor_info=realtor_info,
-                realtor_photo=(realtor.photo.strip() if (realtor and realtor.photo) else None) if realtor else None,
+                realtor_photo=realtor_photo,
                 logos=list(logos),
                 property_images=list(images),
                 img_count=img_count,
                 text_count=text_count,
-            )
+                n_property_images=len(images),
+                n_logos=len(logos),
+                has_realtor_photo=1 if realtor_photo else 0,
+                n_text_fields=len(children),
+            ))
+            template_children.append(children)
+            seen_names.add(t.template_name)
 
-            db.add(db_template)
-            db.flush()  # obtain db_template.id before adding children
+        except Exception as e:
+            errors.append(
+                {"index": i, "template_name": obj.get("template_name"), "error": "invalid_item", "detail": str(e)})
 
-            # 4) Add text fields (children)
-            children = []
-            for name, spec in t.text_fields.items():
-                # enforce clean key
-                key = name.strip()
-                if not key:
-                    continue
-                children.append(
-                    TextFieldModel(
-                        template_id=db_template.id,
-                        name=key,
-                        approx_length=spec.approx_length,
-                        format=spec.format.strip(),
-                    )
-                )
-
-            if children:
-                db.add_all(children)
-
-            # 5) Commit this item (isolate duplicates/violations)
+    # 5) Insert all accepted templates and their text fields in a single transaction
+    if templates:
+        try:
+            db.bulk_save_objects(templates, return_defaults=True)  # populates template ids
+            db.bulk_insert_mappings(TextFieldModel, [
+                {**child, "template_id": template.id}
+                for template, children in zip(templates, template_children)
+                for child in children
+            ])
             db.commit()
-            accepted += 1
-
         except IntegrityError as ie:
             db.rollback()
-            # assume UNIQUE(template_name) conflict => duplicate
-            duplicates += 1
-            errors.append(
-                {"index": i, "template_name": obj.get("template_name"), "error": "duplicate", "detail": str(ie.orig)})
-        except Exception as e:
-            db.rollback()
-            errors.append(
-                {"index": i, "template_name": obj.get("template_name"), "error": "invalid_item", "detail": str(e)})
+            # a concurrent upload stored one of these names after our lookup
+            raise HTTPException(status_code=409, detail=f"Conflicting template upload, nothing was saved: {ie.orig}")
+        accepted = len(templates)
 
     return {
         "accepted": accepted,
@@ -137,6 +211,117 @@ async def select_template(
         address: str = Form(...),
         db: Session = Depends(get_db)
 ):
+    return await run_template_selection(text_file, images, name, email, address, db)
+
+
+@app.post("/select-template-batch/")
+async def select_template_batch(
+        request: Request,
+        db: Session = Depends(get_db)
+):
+    """
+    Runs several template selections from one multipart request.
+    `scenarios_meta` is a JSON array of {name, email, address}; scenario i sends its
+    `scenarios[i].text_file` part and one or more `scenarios[i].images` parts.
+    """
+    form = await request.form()
+    try:
+        scenarios_meta = orjson.loads(form.get("scenarios_meta") or "")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid scenarios_meta JSON: {e}")
+
+    if not isinstance(scenarios_meta, list) or not scenarios_meta:
+        raise HTTPException(status_code=400, detail="scenarios_meta must be a non-empty JSON array")
+
+    # Scenarios share one DB session, so they run one after another; a failure only affects its own entry
+    results: List[Dict[str, Any]] = []
+    for i, meta in enumerate(scenarios_meta):
+        text_file = form.get(f"scenarios[{i}].text_file")
+        images = [part for part in form.getlist(f"scenarios[{i}].images") if not isinstance(part, str)]
+        try:
+            if not isinstance(meta, dict) or not all(isinstance(meta.get(k), str) for k in ("name", "email", "address")):
+                raise HTTPException(status_code=400, detail="Each scenario needs string name, email and address")
+            if text_file is None or isinstance(text_file, str) or not images:
+                raise HTTPException(status_code=400, detail=f"Scenario {i} needs a text_file and at least one image")
+
+            results.append(await run_template_selection(
+                text_file, images, meta["name"], meta["email"], meta["address"], db
+            ))
+        except HTTPException as e:
+            results.append({"error": e.detail, "status_code": e.status_code})
+
+    return batch_response(results)
+
+
+@app.post("/select-template-urls/")
+async def select_template_urls(
+        item: UrlSelectionRequest,
+        db: Session = Depends(get_db)
+):
+    """Same as /select-template/, but the description is sent as text and the images as URLs the server fetches."""
+    return await run_url_template_selection(item, db)
+
+
+@app.post("/select-template-urls-batch/")
+async def select_template_urls_batch(
+        items: List[UrlSelectionRequest],
+        db: Session = Depends(get_db)
+):
+    """
+    Runs /select-template-urls/ for every listing of a JSON array and returns their results in order.
+    """
+    if not items:
+        raise HTTPException(status_code=400, detail="Expected a non-empty JSON array of listings")
+
+    # Listings share one DB session, so they run one after another; a failure only affects its own entry
+    results: List[Dict[str, Any]] = []
+    for item in items:
+        try:
+            results.append(await run_url_template_selection(item, db))
+        except HTTPException as e:
+            results.append({"error": e.detail, "status_code": e.status_code})
+
+    return batch_response(results)
+
+
+def batch_response(results: List[Dict[str, Any]]) -> ORJSONResponse:
+    """Wrap per-listing results; X-AutoBatch-Completed lets clients spot partial failures without walking them."""
+    completed = sum(1 for r in results if "error" not in r)
+    return ORJSONResponse({"results": results}, headers={"X-AutoBatch-Completed": str(completed)})
+
+
+async def fetch_image(url: str) -> UploadFile:
+    """Download one listing image into an in-memory UploadFile so it goes through the upload pipeline unchanged."""
+    if not url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=400, detail=f"Unsupported image URL: {url}")
+    try:
+        response = await http_client.get(url, follow_redirects=True, timeout=15)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=400, detail=f"Failed to fetch image {url}: {e}")
+
+    # Keep the URL's file name so the filename heuristic in the classifier still applies
+    filename = os.path.basename(httpx.URL(url).path) or "image"
+    headers = Headers({"content-type": response.headers.get("content-type", "application/octet-stream")})
+    return UploadFile(io.BytesIO(response.content), filename=filename, headers=headers)
+
+
+async def run_url_template_selection(item: UrlSelectionRequest, db: Session) -> Dict[str, Any]:
+    """Fetch a URL-based listing's images concurrently, then run the regular template selection on it."""
+    images = await asyncio.gather(*(fetch_image(url) for url in item.image_urls))
+    text_file = UploadFile(io.BytesIO(item.text_data.encode("utf-8")), filename="text_data.txt")
+    return await run_template_selection(text_file, list(images), item.name, item.email, item.address, db)
+
+
+async def run_template_selection(
+        text_file: UploadFile,
+        images: List[UploadFile],
+        name: str,
+        email: str,
+        address: str,
+        db: Session,
+) -> Dict[str, Any]:
+    """Select and fill the best matching template for one listing (text file + images)."""
     # 1) Read text payload
     try:
         content = await text_file.read()
@@ -148,7 +333,7 @@ async def select_template(
         raise HTTPException(status_code=400, detail=f"Failed to read text file: {e}")
 
     # 2) Classify images via CLIP
-    results = []
+    results: List[Dict[str, Any]] = [{} for _ in images]
     property_images = 0
     property_images_list: List[str] = []
 
@@ -158,112 +343,153 @@ async def select_template(
     logos = 0
     logo_images: List[str] = []
 
-    for img in images:
-        try:
-            raw = await img.read()
-            file_bytes = np.asarray(bytearray(raw), dtype=np.uint8)
-            img_np = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-
-            label, score = clip.classify(img_np)
-
-            if clip.is_logo_related(label):
-                logos += 1
-                logo_images.append(img.filename)
-            if clip.is_person_related(label):
-                realtor_photos += 1
-                realtor_images_list.append(img.filename)
-            if clip.is_house_related(label):
-                property_images += 1
-                property_images_list.append(img.filename)
-
-            results.append({
-                "filename": img.filename,
-                "label": label,
-                "score": round(float(score), 4),
-                "category": (
-                    "house" if clip.is_house_related(label) else
-                    "logo" if clip.is_logo_related(label) else
-                    "person" if clip.is_person_related(label) else
-                    "other"
-                )
-            })
-        except Exception as e:
+    # Filenames/MIME types that already give the category away skip CLIP (heuristic hits count as certain)
+    classified: List[Optional[Tuple[str, float]]] = [None] * len(images)
+    to_read: List[int] = []
+    for i, img in enumerate(images):
+        label = clip.classify_by_filename(img.filename, img.content_type)
+        if label is not None:
+            classified[i] = (label, 1.0)
+        else:
+            to_read.append(i)
+
+    # Read the rest concurrently; anything not already in the cache goes through CLIP in one batch
+    raws = await asyncio.gather(*(images[i].read() for i in to_read), return_exceptions=True)
+
+    # Cache hits need no decoding; everything else is decoded in worker threads off the event loop
+    to_decode: List[Tuple[int, bytes, bytes]] = []
+    for i, raw in zip(to_read, raws):
+        if isinstance(raw, Exception):
             # If one image fails, continue; you can choose to hard-fail instead.
-            results.append({
-                "filename": img.filename,
+            results[i] = {
+                "filename": images[i].filename,
+                "error": f"classification_failed: {raw}"
+            }
+            continue
+
+        key = hashlib.sha1(raw).digest()
+        cached = classification_cache.get(key)
+        if cached is not None:
+            classified[i] = cached
+        else:
+            to_decode.append((i, key, raw))
+
+    decoded_images = await asyncio.gather(
+        *(asyncio.to_thread(decode_image, raw) for _, _, raw in to_decode),
+        return_exceptions=True,
+    )
+
+    pending: List[int] = []
+    pending_keys: List[bytes] = []
+    img_arrays: List[np.ndarray] = []
+    for (i, key, _), img_np in zip(to_decode, decoded_images):
+        if isinstance(img_np, Exception):
+            results[i] = {
+                "filename": images[i].filename,
+                "error": f"classification_failed: {img_np}"
+            }
+            continue
+        pending.append(i)
+        pending_keys.append(key)
+        img_arrays.append(img_np)
+
+    try:
+        for i, key, result in zip(pending, pending_keys, clip.classify_batch(img_arrays) if img_arrays else []):
+            classified[i] = result
+            classification_cache[key] = result
+    except Exception as e:
+        for i in pending:
+            results[i] = {
+                "filename": images[i].filename,
                 "error": f"classification_failed: {e}"
-            })
+            }
+
+    for i, result in enumerate(classified):
+        if result is None:
+            continue
+        label, score = result
+        img = images[i]
+        category = clip.category(label)
+        if category == "logo":
+            logos += 1
+            logo_images.append(img.filename)
+        elif category == "person":
+            realtor_photos += 1
+            realtor_images_list.append(img.filename)
+        elif category == "house":
+            property_images += 1
+            property_images_list.append(img.filename)
+
+        results[i] = {
+            "filename": img.filename,
+            "label": label,
+            "score": round(float(score), 4),
+            "category": category,
+        }
 
     image_count = len(images)
 
-    # 3) Load all templates from DB (normalized schema)
-    all_templates: List[TemplateModel] = db.query(TemplateModel).all()
-    if not all_templates:
+    # 3) Score every template in SQL and fetch only the top candidates (lower is better)
+    n_prop = TemplateModel.n_property_images
+    n_logos = TemplateModel.n_logos
+    has_photo = TemplateModel.has_realtor_photo
+    n_text = TemplateModel.n_text_fields
+
+    # 1. Image Distribution Score (most important)
+    distribution_score = (
+        func.abs(n_prop - property_images)
+        + func.abs(n_logos - logos)
+        + func.abs(has_photo - realtor_photos)
+    )
+
+    # 2. Total Image Count Score (secondary)
+    t_total = n_prop + n_logos + has_photo
+    input_total = property_images + logos + realtor_photos
+    total_count_penalty = func.abs(t_total - input_total)
+
+    # 3. Template Flexibility Score (bonus for templates with more text fields)
+    flexibility_bonus = -case((n_text >= 10, 1.0), else_=n_text * 0.1)  # Max bonus of 1.0
+
+    # 4. Realtor Photo Compatibility Score
+    if realtor_photos > 0:
+        realtor_compatibility = case((has_photo == 0, 2), else_=0)  # Realtor photos but no slot
+    else:
+        realtor_compatibility = case((has_photo == 1, 1), else_=0)  # Slot but no photos
+
+    # 5. Image Capacity Score (penalty for having too many required images)
+    capacity_penalty = case((t_total > input_total, (t_total - input_total) * 0.5), else_=0)
+
+    score = (
+        distribution_score * 3 +  # Most important factor
+        total_count_penalty * 2 +  # Secondary factor
+        realtor_compatibility * 2 +  # Important for realtor photos
+        capacity_penalty +  # Minor penalty for excess capacity
+        flexibility_bonus  # Bonus for flexibility
+    ).label("score")
+
+    top_rows = (
+        db.query(TemplateModel, score)
+        .options(selectinload(TemplateModel.text_fields))
+        .order_by(score, TemplateModel.id)
+        .limit(3)
+        .all()
+    )
+    if not top_rows:
         raise HTTPException(status_code=404, detail="No templates available")
 
-    # Improved template selection algorithm
-    def calculate_template_score(t: TemplateModel) -> float:
-        """Calculate comprehensive score for template matching"""
-        t_prop_imgs = len(t.property_images or [])
-        t_logos = len(t.logos or [])
-        t_realtor_photo = 1 if t.realtor_photo else 0
-        
-        # 1. Image Distribution Score (most important)
-        property_penalty = abs(t_prop_imgs - property_images)
-        logo_penalty = abs(t_logos - logos)
-        realtor_penalty = abs(t_realtor_photo - realtor_photos)
-        distribution_score = property_penalty + logo_penalty + realtor_penalty
-        
-        # 2. Total Image Count Score (secondary)
-        t_total = t_prop_imgs + t_logos + t_realtor_photo
-        input_total = property_images + logos + realtor_photos
-        total_count_penalty = abs(t_total - input_total)
-        
-        # 3. Template Flexibility Score (bonus for templates with more text fields)
-        text_fields_count = len(t.text_fields or [])
-        flexibility_bonus = -min(text_fields_count * 0.1, 1.0)  # Max bonus of 1.0
-        
-        # 4. Realtor Photo Compatibility Score
-        realtor_compatibility = 0
-        if realtor_photos > 0 and not t.realtor_photo:
-            realtor_compatibility = 2  # Penalty for having realtor photos but no slot
-        elif realtor_photos == 0 and t.realtor_photo:
-            realtor_compatibility = 1  # Minor penalty for having slot but no photos
-        
-        # 5. Image Capacity Score (penalty for having too many required images)
-        capacity_penalty = 0
-        if t_total > input_total:
-            capacity_penalty = (t_total - input_total) * 0.5
-        
-        # Calculate total score (lower is better)
-        total_score = (
-            distribution_score * 3 +  # Most important factor
-            total_count_penalty * 2 +  # Secondary factor
-            realtor_compatibility * 2 +  # Important for realtor photos
-            capacity_penalty +  # Minor penalty for excess capacity
-            flexibility_bonus  # Bonus for flexibility
-        )
-        
-        return total_score
+    top_candidates = [(t.template_name, float(s)) for t, s in top_rows]
 
-    # Sort templates by score (lower is better)
-    template_scores = [(t, calculate_template_score(t)) for t in all_templates]
-    template_scores.sort(key=lambda x: x[1])
-    
     # Pick best match
-    best_match: TemplateModel = template_scores[0][0]
-    
+    best_match: TemplateModel = top_rows[0][0]
+    best_score = top_candidates[0][1]
+
     # Debug: Print template selection info
-    print(f"DEBUG: Selected template {best_match.template_name} with score {template_scores[0][1]:.2f}")
-    print(f"DEBUG: Top 3 candidates: {[(t.template_name, score) for t, score in template_scores[:3]]}")
+    print(f"DEBUG: Selected template {best_match.template_name} with score {best_score:.2f}")
+    print(f"DEBUG: Top 3 candidates: {top_candidates}")
 
-    # 4) Rebuild text_fields dict from child rows for prompt
+    # 4) Rebuild text_fields dict from child rows for prompt (eager-loaded with the template)
     #    Each child has: name, approx_length, format
-    children: List[TextFieldModel] = (
-        db.query(TextFieldModel)
-        .filter(TextFieldModel.template_id == best_match.id)
-        .all()
-    )
+    children: List[TextFieldModel] = best_match.text_fields
     best_match_text_fields: Dict[str, Dict[str, Any]] = {
         c.name: {"approx_length": c.approx_length, "format": c.format}
         for c in children
@@ -275,26 +501,39 @@ async def select_template(
         raise HTTPException(status_code=422, detail=f"Template '{best_match.template_name}' has no text fields")
 
     # 5) Ask GPT to extract/assign text values for text_fields
+    format_key = (best_match.id, best_match.template_name)
+    response_format = extraction_formats.get(format_key)
+    if response_format is None:
+        response_format = extraction_formats[format_key] = build_extraction_schema(best_match_text_fields)
+
     try:
-        completion = openai_client.chat.completions.create(
+        completion = await openai_client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": build_extraction_prompt(
                 best_match_text_fields,  # strict dict: {field: {approx_length, format}}
                 decoded
             )}],
             temperature=0.3,
+            response_format=response_format,
         )
         gpt_result = completion.choices[0].message.content.strip()
         print(gpt_result)
-        assigned_fields = json.loads(gpt_result)  # Expecting dict: { field_name: "value", ... }
-        for field in assigned_fields:
-            for template_field in best_match_text_fields:
-                if field == template_field and assigned_fields[field] is not None:
-                    max_size = best_match_text_fields[template_field]["approx_length"]
-                    assigned_fields[field] = truncate_text_if_needed(assigned_fields[field], max_size)
-
+        assigned_fields = orjson.loads(gpt_result)  # Expecting dict: { field_name: "value", ... }
         if not isinstance(assigned_fields, dict):
             raise ValueError("Model did not return a JSON object mapping field names to values")
+
+        # Shorten all overlong fields concurrently
+        overlong = [
+            field for field, value in assigned_fields.items()
+            if field in best_match_text_fields
+            and isinstance(value, str)
+            and len(value) > best_match_text_fields[field]["approx_length"]
+        ]
+        truncated = await asyncio.gather(*(
+            truncate_text_if_needed(assigned_fields[field], best_match_text_fields[field]["approx_length"])
+            for field in overlong
+        ))
+        assigned_fields.update(zip(overlong, truncated))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"GPT data extraction failed: {e}")
 
@@ -342,7 +581,7 @@ async def select_template(
                 "img_count": best_match.img_count,
                 "text_count": best_match.text_count,
                 "n_text_fields": len(best_match_text_fields),
-                "selection_score": template_scores[0][1],  # Score of selected template
+                "selection_score": best_score,  # Score of selected template
             },
             "image_stats": {
                 "input_total": image_count,
@@ -351,8 +590,8 @@ async def select_template(
                 "realtor_photos": realtor_photos,
             },
             "template_ranking": [
-                {"template_name": t.template_name, "score": score} 
-                for t, score in template_scores[:3]  # Top 3 candidates
+                {"template_name": template_name, "score": score}
+                for template_name, score in top_candidates  # Top 3 candidates
             ],
             "classification": results,  # optional: per-image classification summary
         }
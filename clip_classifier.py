@@ -1,17 +1,71 @@
 # clip_classifier.py
 
+import hashlib
+import os
+import re
+from typing import Optional
+
 import torch
-import clip
+import open_clip
 import cv2
-from PIL import Image
 import numpy as np
 from loguru import logger
 
 
+MODEL_NAME = "ViT-B-32"
+PRETRAINED = "openai"
+
+# Batch sizes the compiled CUDA encoder is warmed up for; batches are padded up to the next one
+# (and split beyond the largest) so a new image count never recompiles or re-records a CUDA graph
+BATCH_BUCKETS = (1, 2, 4, 8, 16)
+
+# Whole tokens of the lowercased filename stem only, so e.g. "silicon_valley" or "brandywine" go through CLIP
+LOGO_FILENAME_PATTERN = re.compile(r"(?<![a-z])(logo|brand|icon)s?(?![a-z])")
+PERSON_FILENAME_PATTERN = re.compile(r"(?<![a-z])(agent|realtor|headshot|profile|portrait)s?(?![a-z])")
+
+
+def category_from_filename(filename: Optional[str], content_type: Optional[str] = None) -> Optional[str]:
+    """
+    Returns "logo" or "person" when the filename or MIME type alone identifies the image, else None.
+    """
+    name = os.path.basename(filename or "").lower()
+    stem, ext = os.path.splitext(name)
+    if ext == ".svg" or content_type == "image/svg+xml" or LOGO_FILENAME_PATTERN.search(stem):
+        return "logo"
+    if PERSON_FILENAME_PATTERN.search(stem):
+        return "person"
+    return None
+
+
 class ClipImageClassifier:
     def __init__(self, device: str = None):
         self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
-        self.model, self.preprocess = clip.load("ViT-B/32", device=self.device)
+        self.model, _, _ = open_clip.create_model_and_transforms(MODEL_NAME, pretrained=PRETRAINED, device=self.device)
+        self.model.eval()
+
+        # FP16 on GPU; the CPU fallback stays in FP32
+        use_cuda = self.device.startswith("cuda")
+        self.dtype = torch.float16 if use_cuda else torch.float32
+        self.model = self.model.to(self.dtype)
+        self.input_size = self.model.visual.image_size[0]
+
+        # CLIP normalization constants, kept on device so batches are normalized there
+        self.mean = torch.tensor(open_clip.OPENAI_DATASET_MEAN, device=self.device, dtype=self.dtype).view(1, 3, 1, 1)
+        self.std = torch.tensor(open_clip.OPENAI_DATASET_STD, device=self.device, dtype=self.dtype).view(1, 3, 1, 1)
+
+        # Fuse the image encoder on GPU; every bucket is compiled on a warm-up call rather than on a request
+        self._compiled = use_cuda
+        if use_cuda:
+            self.encode_image = torch.compile(
+                self.model.encode_image, mode="reduce-overhead", fullgraph=True, dynamic=False
+            )
+            with torch.no_grad():
+                for bucket in BATCH_BUCKETS:
+                    self.encode_image(
+                        torch.zeros(bucket, 3, self.input_size, self.input_size, device=self.device, dtype=self.dtype)
+                    )
+        else:
+            self.encode_image = self.model.encode_image
 
         # Default categories (can be customized)
         self.house_categories = [
@@ -35,37 +89,143 @@ class ClipImageClassifier:
         ]
 
         self.categories = self.house_categories + self.logo + self.person_categories
-        self.text_tokens = clip.tokenize(self.categories).to(self.device)
 
-    def classify(self, roi: np.ndarray) -> tuple[str, float]:
+        # Constant-time label lookups
+        self._house_set = frozenset(self.house_categories)
+        self._logo_set = frozenset(self.logo)
+        self._person_set = frozenset(self.person_categories)
+        self._category_map = {
+            **{label: "house" for label in self.house_categories},
+            **{label: "logo" for label in self.logo},
+            **{label: "person" for label in self.person_categories},
+        }
+        self.text_tokens = open_clip.get_tokenizer(MODEL_NAME)(self.categories).to(self.device)
+
+        # Categories are fixed, so encode the prompts once and reuse them for every image
+        self.text_features = self._load_text_features()
+
+    def _load_text_features(self) -> torch.Tensor:
         """
-        Classifies a single image ROI using CLIP and returns best label and score.
+        Returns L2-normalized text embeddings for self.categories, cached under /tmp.
         """
-        if roi.size == 0:
-            return "invalid", 0.0
+        key = hashlib.sha1((f"{MODEL_NAME}/{PRETRAINED}\n" + "\n".join(self.categories)).encode("utf-8")).hexdigest()
+        cache_path = os.path.join("/tmp", f"clip_text_emb_{key}.pt")
 
-        roi_rgb = cv2.cvtColor(roi, cv2.COLOR_BGR2RGB)
-        roi_pil = Image.fromarray(roi_rgb)
-        roi_tensor = self.preprocess(roi_pil).unsqueeze(0).to(self.device)
+        if os.path.exists(cache_path):
+            # /tmp is world-writable: never unpickle arbitrary objects, and reject tensors of the wrong shape
+            expected_shape = (len(self.categories), self.model.visual.output_dim)
+            try:
+                cached = torch.load(cache_path, map_location=self.device, weights_only=True)
+                if isinstance(cached, torch.Tensor) and tuple(cached.shape) == expected_shape:
+                    return cached.to(self.dtype)
+                logger.warning(f"Ignoring CLIP text embedding cache {cache_path} with unexpected contents")
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable CLIP text embedding cache {cache_path}: {e}")
 
         with torch.no_grad():
-            image_features = self.model.encode_image(roi_tensor)
             text_features = self.model.encode_text(self.text_tokens)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
             text_features /= text_features.norm(dim=-1, keepdim=True)
 
-            similarity = image_features @ text_features.T
-            best_idx = similarity.argmax().item()
-            best_label = self.categories[best_idx]
-            score = similarity[0, best_idx].item()
+        try:
+            torch.save(text_features.float().cpu(), cache_path)
+        except OSError as e:
+            logger.warning(f"Could not write CLIP text embedding cache {cache_path}: {e}")
 
-        return best_label, score
+        return text_features
+
+    def _resize_crop(self, roi: np.ndarray) -> np.ndarray:
+        """
+        Resizes the shorter side to the model input size and center-crops, as CLIP's own preprocess does.
+        """
+        h, w = roi.shape[:2]
+        scale = self.input_size / min(h, w)
+        new_w, new_h = max(self.input_size, round(w * scale)), max(self.input_size, round(h * scale))
+        # INTER_AREA antialiases when shrinking (PIL's bicubic resize in CLIP's preprocess does too);
+        # plain cubic would alias multi-megapixel photos. Cubic is kept for upscaling only.
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+        resized = cv2.resize(roi, (new_w, new_h), interpolation=interpolation)
+        top, left = (new_h - self.input_size) // 2, (new_w - self.input_size) // 2
+        return resized[top:top + self.input_size, left:left + self.input_size]
+
+    def _to_batch(self, rois: list[np.ndarray]) -> torch.Tensor:
+        """
+        Builds a normalized (N, 3, H, W) tensor on the model device from BGR images.
+        """
+        crops = np.stack([cv2.cvtColor(self._resize_crop(roi), cv2.COLOR_BGR2RGB) for roi in rois])
+        batch = torch.from_numpy(crops).to(self.device, non_blocking=True)
+        batch = batch.permute(0, 3, 1, 2).to(self.dtype) / 255.0
+        return (batch - self.mean) / self.std
+
+    def _encode(self, batch: torch.Tensor) -> torch.Tensor:
+        """
+        Runs the image encoder; when compiled, each chunk is zero-padded to a warmed-up bucket size.
+        """
+        if not self._compiled:
+            return self.encode_image(batch)
+
+        outputs = []
+        for start in range(0, batch.shape[0], BATCH_BUCKETS[-1]):
+            chunk = batch[start:start + BATCH_BUCKETS[-1]]
+            n = chunk.shape[0]
+            bucket = next(b for b in BATCH_BUCKETS if b >= n)
+            if bucket > n:
+                chunk = torch.cat([chunk, chunk.new_zeros((bucket - n, *chunk.shape[1:]))])
+            # clone: compiled outputs are CUDA graph buffers reused on the next call
+            outputs.append(self.encode_image(chunk)[:n].clone())
+        return torch.cat(outputs)
+
+    def classify(self, roi: np.ndarray) -> tuple[str, float]:
+        """
+        Classifies a single image ROI using CLIP and returns best label and score.
+        """
+        return self.classify_batch([roi])[0]
+
+    def classify_batch(self, rois: list[np.ndarray]) -> list[tuple[str, float]]:
+        """
+        Classifies a list of image ROIs in a single CLIP forward pass.
+        Returns one (label, score) tuple per ROI, in input order.
+        """
+        results: list[tuple[str, float]] = [("invalid", 0.0)] * len(rois)
+        valid = [i for i, roi in enumerate(rois) if roi is not None and roi.size > 0]
+        if not valid:
+            return results
+
+        with torch.no_grad():
+            tensors = self._to_batch([rois[i] for i in valid])
+            image_features = self._encode(tensors)
+            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+
+            similarity = image_features @ self.text_features.T
+            best_scores, best_idx = similarity.max(dim=-1)
+
+        for i, idx, score in zip(valid, best_idx.tolist(), best_scores.tolist()):
+            results[i] = (self.categories[idx], score)
+
+        return results
+
+    def classify_by_filename(self, filename: Optional[str], content_type: Optional[str] = None) -> Optional[str]:
+        """
+        Returns a category label when the filename or MIME type already identifies the image, else None.
+        Ambiguous files return None and should go through CLIP.
+        """
+        category = category_from_filename(filename, content_type)
+        if category == "logo":
+            return self.logo[0]
+        if category == "person":
+            return self.person_categories[0]
+        return None
+
+    def category(self, label: str) -> str:
+        """
+        Maps a label to "house", "logo", "person" or "other".
+        """
+        return self._category_map.get(label, "other")
 
     def is_house_related(self, label: str) -> bool:
-        return label in self.house_categories
+        return label in self._house_set
 
     def is_logo_related(self, label: str) -> bool:
-        return label in self.logo
+        return label in self._logo_set
 
     def is_person_related(self, label: str) -> bool:
-        return label in self.person_categories
+        return label in self._person_set
@@ -3,10 +3,17 @@
 Debug test to check what's happening with the template selection
 """
 
+import ijson
 import requests
+from requests.adapters import HTTPAdapter
 import json
 from io import BytesIO
 
+# One pooled keep-alive session reused for every request
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=10))
+SESSION.headers.update({"Connection": "keep-alive"})
+
 def test_debug():
     # Create a simple test image (1x1 pixel PNG)
     png_data = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00\x90wS\xde\x00\x00\x00\tpHYs\x00\x00\x0b\x13\x00\x00\x0b\x13\x01\x00\x9a\x9c\x18\x00\x00\x00\nIDATx\x9cc```\x00\x00\x00\x04\x00\x01\xdd\x8d\xb4\x1c\x00\x00\x00\x00IEND\xaeB`\x82'
@@ -28,14 +35,20 @@ def test_debug():
         files[f'images'] = (f'property_{i+1}.jpg', BytesIO(png_data), 'image/jpeg')
     
     try:
-        response = requests.post('http://localhost:2500/select-template/', data=form_data, files=files)
+        response = SESSION.post('http://localhost:2500/select-template/', data=form_data, files=files, stream=True)
         print(f'Status: {response.status_code}')
         
         if response.status_code == 200:
-            result = response.json()
-            print('Full response keys:', list(result.keys()))
+            # Parse the body top-level key by key as it streams in; only the debug section is kept
+            response.raw.decode_content = True
+            result_keys = []
+            debug = {}
+            for key, value in ijson.kvitems(response.raw, '', use_float=True):
+                result_keys.append(key)
+                if key == 'debug':
+                    debug = value
+            print('Full response keys:', result_keys)
             
-            debug = result.get('debug', {})
             print('Debug keys:', list(debug.keys()))
             
             if 'chosen_template' in debug:
@@ -1,3 +1,6 @@
+import functools
+
+
 def truncate_fields(fields_dict, max_length=100):
     """Truncate string values in a dict if they're too long."""
     truncated = {}
@@ -13,18 +16,43 @@ def build_truncation_prompt(text):
     return f"Shorten the following text: {text}. Return only the shortened text and nothing else"
 
 
-def build_extraction_prompt(fields: list, input_text: str) -> str:
+def build_extraction_schema(fields: dict) -> dict:
     """
-    fields: list of fields
-    input_text: unstructured input text
+    fields: {field: {approx_length, format}}
+    Returns an OpenAI `response_format` enforcing one string-or-null value per field.
+    Strict mode does not accept maxLength, so each limit is stated in the description instead.
+    """
+    schema = {
+        "type": "object",
+        "properties": {
+            name: {
+                "type": ["string", "null"],
+                "description": f"max {spec['approx_length']} characters, format like: {spec['format']}",
+            }
+            for name, spec in fields.items()
+        },
+        "required": list(fields),
+        "additionalProperties": False,
+    }
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "template_fields", "schema": schema, "strict": True},
+    }
+
+
+@functools.lru_cache(maxsize=32)
+def _prompt_skeleton(fields_key: tuple) -> tuple:
+    """
+    fields_key: ((field, approx_length, format), ...) in field order
+    Returns the parts of the extraction prompt before and after the input text.
     """
     field_list = "\n".join(
-        [f"- {name}, approx_size: {fields[name]['approx_length']}, format: {fields[name]['format']}" for name in
-         fields])
-    json_template = "{\n" + ",\n".join([f'  "{name}": "..."' for name in fields]) + "\n}"
-    print(field_list)
+        f"- {name}, approx_size: {approx_length}, format: {fmt}" for name, approx_length, fmt in fields_key)
+    json_template = "{\n" + ",\n".join(
+        f'  "{name}": "... (max {approx_length} characters, format like: {fmt})"'
+        for name, approx_length, fmt in fields_key) + "\n}"
 
-    prompt = f"""
+    prefix = f"""
         You are an intelligent field extractor.
 
 
@@ -42,7 +70,8 @@ def build_extraction_prompt(fields: list, input_text: str) -> str:
         {json_template}
 
         --- Begin Input ---
-        {input_text}
+        """
+    suffix = """
         --- End Input ---
 
         ----------------
@@ -67,6 +96,14 @@ def build_extraction_prompt(fields: list, input_text: str) -> str:
         - If no data is available for a field, use null exactly (no quotes).
 
         """
-    return prompt.strip()
+    return prefix.lstrip(), suffix.rstrip()
 
 
+def build_extraction_prompt(fields: dict, input_text: str) -> str:
+    """
+    fields: {field: {approx_length, format}}
+    input_text: unstructured input text
+    """
+    prefix, suffix = _prompt_skeleton(
+        tuple((name, spec['approx_length'], spec['format']) for name, spec in fields.items()))
+    return prefix + input_text + suffix
@@ -3,48 +3,125 @@
 Improved template selection algorithm that considers multiple factors
 """
 
+import heapq
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Any, Tuple
+
+import numba
+import numpy as np
+
 from db import SessionLocal, TemplateModel, TextFieldModel
 
+@numba.njit(cache=True, fastmath=True)
+def _score_all(prop_arr, logo_arr, rph_arr, flex_arr, property_images, logos, realtor_photos):
+    """
+    Total score of every template (lower is better); same formula as _calculate_template_score
+    """
+    input_total = property_images + logos + realtor_photos
+    scores = np.empty(prop_arr.shape[0], dtype=np.float64)
+    for i in range(prop_arr.shape[0]):
+        distribution_score = (
+            abs(prop_arr[i] - property_images)
+            + abs(logo_arr[i] - logos)
+            + abs(rph_arr[i] - realtor_photos)
+        )
+        t_total = prop_arr[i] + logo_arr[i] + rph_arr[i]
+        total_count_penalty = abs(t_total - input_total)
+        
+        realtor_compatibility = 0
+        if realtor_photos > 0 and rph_arr[i] == 0:
+            realtor_compatibility = 2
+        elif realtor_photos == 0 and rph_arr[i] == 1:
+            realtor_compatibility = 1
+        
+        capacity_penalty = 0.0
+        if t_total > input_total:
+            capacity_penalty = (t_total - input_total) * 0.5
+        
+        scores[i] = (
+            distribution_score * 3 +
+            total_count_penalty * 2 +
+            realtor_compatibility * 2 +
+            capacity_penalty +
+            flex_arr[i]
+        )
+    return scores
+
 class ImprovedTemplateSelector:
     def __init__(self, db_session):
         self.db = db_session
+        
+        # Load templates once; their per-template score constants never change for this selector
+        self.templates: List[TemplateModel] = (
+            self.db.query(TemplateModel).all()
+        )
+        self._cache: List[Dict[str, Any]] = [self._template_constants(t) for t in self.templates]
+        
+        # Same constants as column arrays for _score_all
+        self._prop = np.array([c['t_prop_imgs'] for c in self._cache], dtype=np.int16)
+        self._logos = np.array([c['t_logos'] for c in self._cache], dtype=np.int16)
+        self._rph = np.array([c['t_realtor_photo'] for c in self._cache], dtype=np.int16)
+        self._flex = np.array([c['flexibility_bonus'] for c in self._cache], dtype=np.float64)
+    
+    @staticmethod
+    def _template_constants(template: TemplateModel) -> Dict[str, Any]:
+        """
+        Precompute the parts of the score that depend only on the template
+        """
+        t_prop_imgs = template.prop_count
+        t_logos = template.logo_count
+        t_realtor_photo = template.has_realtor_slot
+        
+        # Templates with more text fields are more flexible
+        text_fields_count = template.text_field_count
+        
+        return {
+            't_prop_imgs': t_prop_imgs,
+            't_logos': t_logos,
+            't_realtor_photo': t_realtor_photo,
+            't_total': t_prop_imgs + t_logos + t_realtor_photo,
+            'text_fields_count': text_fields_count,
+            'flexibility_bonus': -min(text_fields_count * 0.1, 1.0),  # Max bonus of 1.0
+        }
     
     def select_best_template(self, property_images: int, logos: int, realtor_photos: int) -> Tuple[TemplateModel, Dict[str, Any]]:
         """
         Select the best template based on multiple scoring factors
         """
-        all_templates = self.db.query(TemplateModel).all()
-        if not all_templates:
+        if not self.templates:
             raise ValueError("No templates available")
         
-        # Calculate scores for each template
-        template_scores = []
-        for template in all_templates:
-            score_data = self._calculate_template_score(
-                template, property_images, logos, realtor_photos
-            )
-            template_scores.append((template, score_data))
-        
-        # Sort by total score (lower is better)
-        template_scores.sort(key=lambda x: x[1]['total_score'])
+        # A template whose slots match the input exactly scores just its flexibility bonus (in [-1, 0]),
+        # while any mismatch costs at least 3; if enough of them exist they fill the whole top 3
+        exact = np.flatnonzero(
+            (self._prop == property_images) & (self._logos == logos) & (self._rph == realtor_photos)
+        )
+        if len(exact) >= min(3, len(self.templates)):
+            total_scores = self._flex
+            candidates = exact.tolist()
+        else:
+            total_scores = _score_all(self._prop, self._logos, self._rph, self._flex, property_images, logos, realtor_photos)
+            candidates = range(len(total_scores))
         
-        best_template, best_score = template_scores[0]
+        # Lower is better; only the top 3 are needed, and nsmallest keeps DB order on ties
+        ranking = heapq.nsmallest(3, candidates, key=total_scores.__getitem__)
+        best_template = self.templates[ranking[0]]
+        best_score = self._calculate_template_score(self._cache[ranking[0]], property_images, logos, realtor_photos)
         
         return best_template, {
             'template': best_template,
             'score': best_score,
-            'all_scores': [(t.template_name, s['total_score']) for t, s in template_scores[:3]]
+            'all_scores': [(self.templates[i].template_name, float(total_scores[i])) for i in ranking]
         }
     
-    def _calculate_template_score(self, template: TemplateModel, property_images: int, logos: int, realtor_photos: int) -> Dict[str, Any]:
+    def _calculate_template_score(self, cached: Dict[str, Any], property_images: int, logos: int, realtor_photos: int) -> Dict[str, Any]:
         """
-        Calculate a comprehensive score for a template
+        Calculate a comprehensive score for a template from its precomputed constants
         """
-        t_prop_imgs = len(template.property_images or [])
-        t_logos = len(template.logos or [])
-        t_realtor_photo = 1 if template.realtor_photo else 0
+        t_prop_imgs = cached['t_prop_imgs']
+        t_logos = cached['t_logos']
+        t_realtor_photo = cached['t_realtor_photo']
         
         # 1. Image Distribution Score (most important)
         # Perfect match = 0, each mismatch = penalty
@@ -55,20 +132,19 @@ class ImprovedTemplateSelector:
         distribution_score = property_penalty + logo_penalty + realtor_penalty
         
         # 2. Total Image Count Score (secondary)
-        t_total = t_prop_imgs + t_logos + t_realtor_photo
+        t_total = cached['t_total']
         input_total = property_images + logos + realtor_photos
         total_count_penalty = abs(t_total - input_total)
         
         # 3. Template Flexibility Score (bonus for templates that can handle variations)
-        # Templates with more text fields are more flexible
-        text_fields_count = len(template.text_fields or [])
-        flexibility_bonus = -min(text_fields_count * 0.1, 1.0)  # Max bonus of 1.0
+        text_fields_count = cached['text_fields_count']
+        flexibility_bonus = cached['flexibility_bonus']
         
         # 4. Realtor Photo Compatibility Score
         realtor_compatibility = 0
-        if realtor_photos > 0 and not template.realtor_photo:
+        if realtor_photos > 0 and not t_realtor_photo:
             realtor_compatibility = 2  # Penalty for having realtor photos but no slot
-        elif realtor_photos == 0 and template.realtor_photo:
+        elif realtor_photos == 0 and t_realtor_photo:
             realtor_compatibility = 1  # Minor penalty for having slot but no photos
         
         # 5. Image Capacity Score (penalty for having too many required images)
@@ -104,11 +180,24 @@ class ImprovedTemplateSelector:
             }
         }
 
+def _run_scenario(selector: ImprovedTemplateSelector, scenario: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Run one selection scenario against the preloaded selector"""
+    best_template, score_data = selector.select_best_template(
+        scenario['property_images'], 
+        scenario['logos'], 
+        scenario['realtor_photos']
+    )
+    return best_template.template_name, score_data
+
 def test_improved_selection():
     """Test the improved template selection with various scenarios"""
     
+    # The selector loads everything up front, so the threads below never touch the DB session
     db = SessionLocal()
-    selector = ImprovedTemplateSelector(db)
+    try:
+        selector = ImprovedTemplateSelector(db)
+    finally:
+        db.close()
     
     scenarios = [
         {"name": "5 property images, 0 logos, 0 realtor photos", "property_images": 5, "logos": 0, "realtor_photos": 0},
@@ -120,29 +209,28 @@ def test_improved_selection():
     
     print("=== IMPROVED TEMPLATE SELECTION TEST ===")
     
-    for scenario in scenarios:
-        print(f"\nScenario: {scenario['name']}")
-        print(f"Input: {scenario['property_images']} property, {scenario['logos']} logos, {scenario['realtor_photos']} realtor")
-        
-        try:
-            best_template, score_data = selector.select_best_template(
-                scenario['property_images'], 
-                scenario['logos'], 
-                scenario['realtor_photos']
-            )
-            
-            print(f"Selected: {best_template.template_name}")
-            print(f"Score: {score_data['score']['total_score']:.2f}")
-            print(f"Template has: {score_data['score']['template_stats']['property_images']} property, {score_data['score']['template_stats']['logos']} logos, realtor_photo={'Yes' if score_data['score']['template_stats']['realtor_photo'] else 'No'}")
+    # Scenarios are independent, so score them concurrently
+    with ThreadPoolExecutor(max_workers=len(scenarios)) as executor:
+        futures = {executor.submit(_run_scenario, selector, scenario): scenario for scenario in scenarios}
+        
+        for future in as_completed(futures):
+            scenario = futures[future]
+            print(f"\nScenario: {scenario['name']}")
+            print(f"Input: {scenario['property_images']} property, {scenario['logos']} logos, {scenario['realtor_photos']} realtor")
             
-            print("Top 3 candidates:")
-            for i, (name, score) in enumerate(score_data['all_scores']):
-                print(f"  {i+1}. {name}: {score:.2f}")
+            try:
+                template_name, score_data = future.result()
                 
-        except Exception as e:
-            print(f"Error: {e}")
-    
-    db.close()
+                print(f"Selected: {template_name}")
+                print(f"Score: {score_data['score']['total_score']:.2f}")
+                print(f"Template has: {score_data['score']['template_stats']['property_images']} property, {score_data['score']['template_stats']['logos']} logos, realtor_photo={'Yes' if score_data['score']['template_stats']['realtor_photo'] else 'No'}")
+                
+                print("Top 3 candidates:")
+                for i, (name, score) in enumerate(score_data['all_scores']):
+                    print(f"  {i+1}. {name}: {score:.2f}")
+                    
+            except Exception as e:
+                print(f"Error: {e}")
 
 if __name__ == "__main__":
     test_improved_selection()
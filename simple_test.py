@@ -3,10 +3,17 @@
 Simple test to check the improved template selection
 """
 
+import ijson
 import requests
+from requests.adapters import HTTPAdapter
 import json
 from io import BytesIO
 
+# One pooled keep-alive session reused for every request
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=10))
+SESSION.headers.update({"Connection": "keep-alive"})
+
 def test_simple():
     # Create a simple test image (1x1 pixel PNG)
     png_data = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00\x90wS\xde\x00\x00\x00\tpHYs\x00\x00\x0b\x13\x00\x00\x0b\x13\x01\x00\x9a\x9c\x18\x00\x00\x00\nIDATx\x9cc```\x00\x00\x00\x04\x00\x01\xdd\x8d\xb4\x1c\x00\x00\x00\x00IEND\xaeB`\x82'
@@ -28,12 +35,17 @@ def test_simple():
     
     try:
         print("Testing with 5 property images, 0 logos, 0 realtor photos...")
-        response = requests.post('http://localhost:2500/select-template/', data=form_data, files=files)
+        response = SESSION.post('http://localhost:2500/select-template/', data=form_data, files=files, stream=True)
         
         print(f"Status: {response.status_code}")
         
         if response.status_code == 200:
-            result = response.json()
+            # Parse the body top-level key by key as it streams in, keeping only the keys used below
+            response.raw.decode_content = True
+            result = {
+                key: value for key, value in ijson.kvitems(response.raw, '', use_float=True)
+                if key in ('template_name', 'output', 'debug')
+            }
             print(f"Selected template: {result['template_name']}")
             print(f"Output: {result['output']}")
             
@@ -4,6 +4,7 @@ Analysis of the template selection logic to understand why it always selects the
 """
 
 import json
+from collections import defaultdict
 from db import SessionLocal, TemplateModel, TextFieldModel
 
 def analyze_template_selection():
@@ -17,6 +18,16 @@ def analyze_template_selection():
     print(f"Total templates in database: {len(templates)}")
     print()
     
+    # Load every template's text fields in one query instead of one per template
+    all_fields = (
+        db.query(TextFieldModel)
+        .filter(TextFieldModel.template_id.in_([t.id for t in templates]))
+        .all()
+    )
+    fields_by_template = defaultdict(list)
+    for f in all_fields:
+        fields_by_template[f.template_id].append(f)
+    
     # Analyze each template
     for i, template in enumerate(templates):
         print(f"Template {i+1}: {template.template_name}")
@@ -30,7 +41,7 @@ def analyze_template_selection():
         print(f"  Realtor info field: {template.realtor_info}")
         
         # Get text fields
-        text_fields = db.query(TextFieldModel).filter(TextFieldModel.template_id == template.id).all()
+        text_fields = fields_by_template[template.id]
         print(f"  Text fields: {len(text_fields)}")
         for tf in text_fields:
             print(f"    - {tf.name}: max_length={tf.approx_length}, format='{tf.format[:50]}...'")
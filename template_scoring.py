@@ -1,12 +1,23 @@
 # selection_semantic.py
+import functools
+import os
+import threading
+
 import numpy as np
-from typing import List, Dict, Any, Tuple
-from sentence_transformers import SentenceTransformer
+import onnxruntime as ort
+from typing import List, Dict, Any, Sequence, Tuple, NamedTuple, Optional
+from tokenizers import Tokenizer
 from sqlalchemy.orm import Session
 from .db import TemplateModel, TextFieldModel
 from .models_embeddings import TextFieldEmbeddingModel
 
 EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_DIM = 384
+# int8 ONNX export of EMBED_MODEL_NAME, produced once offline:
+#   optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 models/all-MiniLM-L6-v2
+#   then onnxruntime.quantization.quantize_dynamic(..., weight_type=QuantType.QInt8)
+EMBED_ONNX_PATH = os.getenv("EMBED_ONNX_PATH", "models/all-MiniLM-L6-v2/model_int8.onnx")
+EMBED_TOKENIZER_PATH = os.getenv("EMBED_TOKENIZER_PATH", "models/all-MiniLM-L6-v2/tokenizer.json")
 
 # Reuse your earlier helpers:
 # - extract_features_from_text(decoded)
@@ -16,29 +27,148 @@ EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 # - value_length(val)
 
 # Build the small set of semantic signals to cover many field variants
-def build_signal_texts(extracted: Dict[str, Any]) -> Dict[str, str]:
-    signals: Dict[str, str] = {}
-    if extracted.get("headline"):
-        signals["headline"] = extracted["headline"]
+# Returns parallel (keys, values) tuples, ready to hand to the encoder
+def build_signal_texts(extracted: Dict[str, Any]) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    keys: List[str] = []
+    values: List[str] = []
+
+    def add(key: str, value: str) -> None:
+        keys.append(key)
+        values.append(value)
+
+    headline = extracted.get("headline")
+    if headline:
+        add("headline", headline)
     # stats (collate)
-    if any(extracted.get(k) is not None for k in ("beds", "baths", "sqft")):
+    beds, baths, sqft = extracted.get("beds"), extracted.get("baths"), extracted.get("sqft")
+    if beds is not None or baths is not None or sqft is not None:
         parts = []
-        if extracted.get("beds") is not None: parts.append(f"{extracted['beds']} beds")
-        if extracted.get("baths") is not None: parts.append(f"{extracted['baths']} baths")
-        if extracted.get("sqft") is not None: parts.append(f"{extracted['sqft']} sqft")
-        signals["stats"] = " | ".join(parts)
-    if extracted.get("price"): signals["price"] = extracted["price"]
-    if extracted.get("address"): signals["address"] = extracted["address"]
-    if extracted.get("features"): signals["features"] = ", ".join(extracted["features"])
-    if extracted.get("body"): signals["body"] = extracted["body"][:500]
+        if beds is not None: parts.append(f"{beds} beds")
+        if baths is not None: parts.append(f"{baths} baths")
+        if sqft is not None: parts.append(f"{sqft} sqft")
+        add("stats", " | ".join(parts))
+    price = extracted.get("price")
+    if price:
+        add("price", price)
+    address = extracted.get("address")
+    if address:
+        add("address", address)
+    features = extracted.get("features")
+    if features:
+        add("features", ", ".join(features))
+    body = extracted.get("body")
+    if body:
+        add("body", body[:500])
     # a couple of strong first lines to help headline/tagline
-    first_line = signals.get("headline") or ""
-    if first_line: signals["headline_alt"] = first_line[:60]
-    return signals
+    if headline:
+        add("headline_alt", headline[:60])
+    return tuple(keys), tuple(values)
+
+class OnnxEmbedder:
+    """Mean-pooled, L2-normalized sentence embeddings from a quantized ONNX MiniLM."""
+
+    def __init__(self, model_path: str, tokenizer_path: str, max_length: int = 256):
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+        self.session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self._needs_token_types = any(i.name == "token_type_ids" for i in self.session.get_inputs())
 
-def cosine_sim(A: np.ndarray, B: np.ndarray) -> np.ndarray:
-    # A: [m, d], B: [n, d], both normalized
-    return A @ B.T
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, EMBED_DIM), dtype=np.float32)
+        encodings = self.tokenizer.encode_batch(list(texts))
+        input_ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+        feed = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if self._needs_token_types:
+            feed["token_type_ids"] = np.zeros_like(input_ids)
+        hidden = self.session.run(None, feed)[0]  # [n, seq, d]
+
+        # Mean over real tokens only, then unit length so dot products are cosine similarities
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return pooled.astype(np.float32, copy=False)
+
+@functools.lru_cache(maxsize=1)
+def _get_model() -> OnnxEmbedder:
+    # Weights are immutable after load; load once per process instead of per request
+    return OnnxEmbedder(EMBED_ONNX_PATH, EMBED_TOKENIZER_PATH)
+
+class FieldMatrix(NamedTuple):
+    key: Tuple[int, ...]              # embedding row ids this matrix was built from
+    index: Dict[int, int]             # template_id -> position in offsets
+    offsets: np.ndarray               # int32 [n_templates + 1]; template i owns rows offsets[i]:offsets[i+1]
+    embeddings: np.ndarray            # float32 [total_fields, d], L2-normalized, contiguous
+    target_lengths: np.ndarray        # float32 [total_fields]
+    expected_types: Tuple[str, ...]   # distinct infer_expected_type() results
+    expected_type_codes: np.ndarray   # int32 [total_fields], index into expected_types
+
+_field_matrix: Optional[FieldMatrix] = None
+
+def load_field_matrix(db: Session, template_ids: List[int]) -> FieldMatrix:
+    """Stack all field embeddings of the given templates into one matrix, rebuilt only when the rows change."""
+    global _field_matrix
+    id_rows = (
+        db.query(TextFieldEmbeddingModel.id)
+        .filter(TextFieldEmbeddingModel.template_id.in_(template_ids))
+        .order_by(TextFieldEmbeddingModel.template_id, TextFieldEmbeddingModel.id)
+        .all()
+    )
+    key = tuple(r.id for r in id_rows)
+    cached = _field_matrix
+    if cached is not None and cached.key == key:
+        return cached
+
+    rows: List[TextFieldEmbeddingModel] = (
+        db.query(TextFieldEmbeddingModel)
+        .filter(TextFieldEmbeddingModel.template_id.in_(template_ids))
+        .order_by(TextFieldEmbeddingModel.template_id, TextFieldEmbeddingModel.id)
+        .all()
+    )
+    index: Dict[int, int] = {}
+    offsets = [0]
+    for r in rows:
+        if r.template_id not in index:
+            index[r.template_id] = len(index)
+            offsets.append(offsets[-1])
+        offsets[-1] += 1
+
+    # reshape keeps the matrix 2-D ([0, d]) when there are no rows
+    embeddings = np.ascontiguousarray([r.embedding for r in rows], dtype=np.float32).reshape(-1, EMBED_DIM)
+    if embeddings.size:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.maximum(norms, 1e-12)
+
+    expected_types: Dict[str, int] = {}
+    type_codes = [
+        expected_types.setdefault(infer_expected_type(r.example_format or ""), len(expected_types))
+        for r in rows
+    ]
+
+    _field_matrix = FieldMatrix(
+        key=key,
+        index=index,
+        offsets=np.asarray(offsets, dtype=np.int32),
+        embeddings=embeddings,
+        target_lengths=np.asarray(
+            [r.approx_length or (len(r.example_format) if r.example_format else 32) for r in rows],
+            dtype=np.float32,
+        ),
+        expected_types=tuple(expected_types),
+        expected_type_codes=np.asarray(type_codes, dtype=np.int32),
+    )
+    return _field_matrix
+
+# Per-thread scratch for the field x signal similarity matrix; grown on demand, never shrunk
+_sim_scratch = threading.local()
+
+def _sim_buffer(rows: int, cols: int) -> np.ndarray:
+    buf = getattr(_sim_scratch, "buf", None)
+    if buf is None or buf.size < rows * cols:
+        buf = _sim_scratch.buf = np.empty(rows * cols, dtype=np.float32)
+    return buf[:rows * cols].reshape(rows, cols)
 
 def score_templates_semantic(
         db: Session,
@@ -47,70 +177,63 @@ def score_templates_semantic(
 ) -> Tuple[TemplateModel, Dict[str, Any]]:
     # 1) Extract signals once
     extracted = extract_features_from_text(decoded_text)
-    signal_texts = build_signal_texts(extracted)
+    sig_keys, sig_vals = build_signal_texts(extracted)
 
     # 2) Embed signals once
-    model = SentenceTransformer(EMBED_MODEL_NAME)
-    sig_keys = list(signal_texts.keys())
-    sig_vecs = model.encode([signal_texts[k] for k in sig_keys], normalize_embeddings=True)
-    S = np.asarray(sig_vecs, dtype=np.float32)  # [Ns, d]
+    model = _get_model()
+    S = model.encode(sig_vals)  # [Ns, d], float32, normalized
 
     # 3) Pull templates + field embeddings
     templates: List[TemplateModel] = db.query(TemplateModel).all()
     if not templates:
         raise ValueError("No templates")
 
-    tf_emb_rows: List[TextFieldEmbeddingModel] = (
-        db.query(TextFieldEmbeddingModel)
-        .filter(TextFieldEmbeddingModel.template_id.in_([t.id for t in templates]))
-        .all()
-    )
-    by_tid: Dict[int, List[TextFieldEmbeddingModel]] = {}
-    for r in tf_emb_rows:
-        by_tid.setdefault(r.template_id, []).append(r)
+    fm = load_field_matrix(db, [t.id for t in templates])
+    if not fm.index:
+        raise ValueError("No scorable templates (missing field embeddings?)")
+
+    # One GEMM for every field of every template instead of one per template
+    # (both sides are L2-normalized, so the dot product is the cosine similarity)
+    sim_all = np.dot(fm.embeddings, S.T, out=_sim_buffer(fm.embeddings.shape[0], S.shape[0]))  # [total_fields, Ns]
+    # best signal per field
+    best_sig_idx = np.argmax(sim_all, axis=1)
+    best_sim = np.take_along_axis(sim_all, best_sig_idx[:, None], axis=1)[:, 0]  # [total_fields]
+
+    # Coverage: how many fields exceed a sim threshold
+    THRESH = 0.45  # tune
+    covered_all = best_sim >= THRESH
+
+    # Length & format fit for every field against its best signal
+    sig_lens = np.asarray([value_length(v) for v in sig_vals], dtype=np.float32)
+    mismatch = np.abs(sig_lens[best_sig_idx] - fm.target_lengths) / np.maximum(fm.target_lengths, 1)
+    length_scores_all = 1.0 - np.minimum(mismatch, 1.0)
+    type_table = np.asarray(
+        [[type_match(expected, v) for v in sig_vals] for expected in fm.expected_types], dtype=np.float32
+    ).reshape(len(fm.expected_types), len(sig_vals))  # [n_types, Ns]
+    format_scores_all = type_table[fm.expected_type_codes, best_sig_idx]
+
+    # Per-template coverage and mean length/format fit over covered fields, as segmented sums
+    # (every template in fm.index owns at least one row, so no reduceat segment is empty)
+    starts = fm.offsets[:-1]
+    counts = np.diff(fm.offsets)
+    covered_f = covered_all.astype(np.float32)
+    n_covered = np.add.reduceat(covered_f, starts)
+    coverage_all = n_covered / counts
+    denom = np.maximum(n_covered, 1.0)
+    length_fit_all = np.where(n_covered > 0, np.add.reduceat(length_scores_all * covered_f, starts) / denom, 0.5)
+    format_fit_all = np.where(n_covered > 0, np.add.reduceat(format_scores_all * covered_f, starts) / denom, 0.5)
 
     # 4) Score each template
     scored = []
     debug_rows = []
 
     for t in templates:
-        fields = by_tid.get(t.id, [])
-        if not fields:
+        slot = fm.index.get(t.id)
+        if slot is None:
             continue
-
-        # gather field vectors
-        F = np.asarray([f.embedding for f in fields], dtype=np.float32)  # [Nf, d]
-        sim = cosine_sim(F, S)  # [Nf, Ns]
-        # best signal per field
-        best_sig_idx = np.argmax(sim, axis=1)
-        best_sim = sim[np.arange(sim.shape[0]), best_sig_idx]  # [Nf]
-
-        # Coverage: how many fields exceed a sim threshold
-        THRESH = 0.45  # tune
-        covered = best_sim >= THRESH
-        coverage = covered.mean() if len(covered) else 0.0
-
-        # Length & format fit computed only for covered fields
-        length_scores = []
-        format_scores = []
-
-        for i, frow in enumerate(fields):
-            if not covered[i]:
-                continue
-            sig_key = sig_keys[best_sig_idx[i]]
-            sig_val = signal_texts.get(sig_key, "")
-            tgt_len = frow.approx_length or (len(frow.example_format) if frow.example_format else 32)
-
-            # length fit
-            mismatch = abs(value_length(sig_val) - tgt_len) / max(tgt_len, 1)
-            length_scores.append(1.0 - min(mismatch, 1.0))
-
-            # format/type fit
-            expected = infer_expected_type(frow.example_format or "")
-            format_scores.append(type_match(expected, sig_val))
-
-        length_fit = sum(length_scores) / len(length_scores) if length_scores else 0.5
-        format_fit = sum(format_scores) / len(format_scores) if format_scores else 0.5
+        coverage = coverage_all[slot]
+        length_fit = length_fit_all[slot]
+        format_fit = format_fit_all[slot]
 
         # Image fit from your earlier function
         img_fit = image_fit_score(t, n_prop, n_logo, n_realtor_ph)
@@ -136,5 +259,5 @@ def score_templates_semantic(
     return best, {
         "best_score": round(float(best_score), 4),
         "scored": debug_rows[:10],
-        "signals": signal_texts,
+        "signals": dict(zip(sig_keys, sig_vals)),
     }
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Regression check for the filename/MIME fast path that skips CLIP
+"""
+
+import pytest
+
+from clip_classifier import category_from_filename
+
+
+@pytest.mark.parametrize("filename, content_type, expected", [
+    # unambiguous names take the fast path
+    ("company_logo.png", "image/png", "logo"),
+    ("logo2.jpg", "image/jpeg", "logo"),
+    ("brand-icons.png", "image/png", "logo"),
+    ("artwork.svg", None, "logo"),
+    ("upload.bin", "image/svg+xml", "logo"),
+    ("agent_photo.jpg", "image/jpeg", "person"),
+    ("jane-headshot.png", "image/png", "person"),
+    ("uploads/realtor.jpg", "image/jpeg", "person"),
+    # keywords inside longer words must go through CLIP
+    ("silicon_valley_home.jpg", "image/jpeg", None),
+    ("property_management.jpg", "image/jpeg", None),
+    ("brandywine_kitchen.jpg", "image/jpeg", None),
+    ("logo_dir/kitchen.jpg", "image/jpeg", None),
+    ("living_room.jpg", "image/jpeg", None),
+    (None, None, None),
+])
+def test_category_from_filename(filename, content_type, expected):
+    assert category_from_filename(filename, content_type) == expected
@@ -2,61 +2,280 @@
 """
 Test script for the updated select-template endpoint
 This demonstrates how to send text data and image URLs instead of file uploads
+
+It targets backend_main.py's /select-template-urls-batch/, which takes a JSON array of
+{text_data, image_urls, name, email, address} and fetches the images itself.
+The client speaks cleartext HTTP/2 (h2c), so serve the app with hypercorn rather than uvicorn:
+`hypercorn backend_main:app --bind 0.0.0.0:2500`
+
+The pytest cases are opt-in integration tests: run them in parallel with
+`SELECT_TEMPLATE_IT=1 SELECT_TEMPLATE_IMAGE_URLS="<url> <url> ..." pytest -n auto test_select_template.py`,
+or run the file directly to send every payload through the batcher
 """
 
-import requests
+import asyncio
 import json
+import os
+import time
+
+import httpx
+import pytest
+
+# orjson parses and encodes bytes in C; the stdlib json fallback still skips text decoding of the response
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+# URL-based batch endpoint; takes a JSON array of payloads and returns their results in order
+BASE_URL = "http://localhost:2500"
+BATCH_URL = f"{BASE_URL}/select-template-urls-batch/"
 
-def test_select_template():
-    # API endpoint
-    url = "http://localhost:9001/select-template/"
-    
-    # Sample data
-    text_data = """
+# Sample data
+TEXT_DATA = """
     Beautiful 3-bedroom house for sale in downtown area.
     Features include hardwood floors, updated kitchen, and large backyard.
     Perfect for families looking for a modern home in a great neighborhood.
     Contact us for more details and scheduling a viewing.
     """
-    
-    # Sample image URLs (replace with actual public image URLs)
-    image_urls = [
-        "https://example.com/house1.jpg",
-        "https://example.com/house2.jpg", 
-        "https://example.com/realtor_photo.jpg",
-        "https://example.com/company_logo.png"
-    ]
-    
-    # Form data - using tuples for multiple values with same key
-    form_data = [
-        ('text_data', text_data),
-        ('name', 'John Smith'),
-        ('email', 'john.smith@realestate.com'),
-        ('address', '123 Main St, City, State 12345')
-    ]
-    
-    # Add image URLs as multiple form fields
-    for img_url in image_urls:
-        form_data.append(('image_urls', img_url))
-    
+
+# Whitespace-separated image URLs the server can fetch; the defaults are placeholders that never resolve
+IMAGE_URLS = os.getenv("SELECT_TEMPLATE_IMAGE_URLS", "").split() or [
+    "https://example.com/house1.jpg",
+    "https://example.com/house2.jpg",
+    "https://example.com/realtor_photo.jpg",
+    "https://example.com/company_logo.png"
+]
+
+REALTOR = {
+    'name': 'John Smith',
+    'email': 'john.smith@realestate.com',
+    'address': '123 Main St, City, State 12345'
+}
+
+# Independent template-selection calls; the batcher coalesces them into batch POSTs
+PAYLOADS = [
+    {'text_data': TEXT_DATA, 'image_urls': IMAGE_URLS, **REALTOR},
+    {'text_data': TEXT_DATA, 'image_urls': IMAGE_URLS[:2], **REALTOR},
+]
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# BASE_URL is cleartext, where httpx only speaks HTTP/2 with prior knowledge (h2c), i.e. with HTTP/1.1 disabled;
+# the server must then accept h2c (hypercorn does, uvicorn does not). Concurrent batch POSTs share one connection
+CLIENT_OPTIONS = dict(
+    http1=False,
+    http2=True,
+    limits=httpx.Limits(max_connections=8, max_keepalive_connections=8),
+    timeout=httpx.Timeout(30, connect=3.05),
+    headers={"Accept": "application/json"},
+)
+
+# Image hosts are arbitrary HTTPS servers: offer HTTP/2 via ALPN but keep HTTP/1.1 as a fallback
+PRECHECK_OPTIONS = dict(
+    http2=True,
+    limits=httpx.Limits(max_connections=8, max_keepalive_connections=8),
+    timeout=httpx.Timeout(3),
+)
+
+def encode_payload(payload, reachable):
+    """
+    JSON-encode a payload once, keeping only reachable image URLs; batches are spliced together from these bytes
+    """
+    return json_dumps({**payload, 'image_urls': [url for url in payload['image_urls'] if url in reachable]})
+
+def warm_up(client):
+    """
+    Open the pooled connection before anything is timed; any status (even 404) means the socket is up.
+    The server has no health route, so the root URL is used and its body ignored
+    """
+    try:
+        client.get(f"{BASE_URL}/", timeout=2)
+    except httpx.HTTPError:
+        pass
+
+async def async_warm_up(client):
+    try:
+        await client.get(f"{BASE_URL}/", timeout=2)
+    except httpx.HTTPError:
+        pass
+
+async def head_ok(client, url):
     try:
-        # Make the request
-        response = requests.post(url, data=form_data)
-        
-        if response.status_code == 200:
-            result = response.json()
-            print("✅ Success!")
-            print("Template selected:", result.get('template_name'))
-            print("Extracted fields:")
-            for key, value in result.items():
-                if key != 'template_name':
-                    print(f"  {key}: {value}")
-        else:
-            print(f"❌ Error: {response.status_code}")
-            print(response.text)
-            
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Request failed: {e}")
+        response = await client.head(url, follow_redirects=True, timeout=3)
+    except httpx.HTTPError:
+        return False
+    return response.is_success
+
+async def reachable_urls(client, urls):
+    """HEAD every distinct URL concurrently and return the ones that answered 2xx"""
+    urls = list(dict.fromkeys(urls))
+    oks = await asyncio.gather(*(head_ok(client, url) for url in urls))
+    return {url for url, ok in zip(urls, oks) if ok}
+
+class Batcher:
+    """
+    Coalesces concurrent submit() calls, each carrying one JSON-encoded payload, into /select-template-urls-batch/ POSTs.
+    A batch goes out once max_batch_size payloads are queued or batch_interval_ms has passed;
+    when no batch is in flight the queued payloads are sent straight away so a lone call never waits.
+    The knobs are plain attributes and may be changed while the batcher is running.
+    """
+
+    def __init__(self, client, url=BATCH_URL, max_batch_size=10, batch_interval_ms=10, enable_batching=True):
+        self.client = client
+        self.url = url
+        self.max_batch_size = max_batch_size
+        self.batch_interval_ms = batch_interval_ms
+        self.enable_batching = enable_batching
+        self._queue = asyncio.Queue()
+        self._in_flight = 0
+        self._sends = set()
+        self._worker = asyncio.create_task(self._run())
+
+    async def submit(self, body):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((body, future))
+        return await future
+
+    async def aclose(self):
+        self._worker.cancel()
+        await asyncio.gather(self._worker, *self._sends, return_exceptions=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            if self.enable_batching:
+                while len(batch) < self.max_batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+
+                # Only hold the batch open while an earlier one is still on the wire
+                deadline = loop.time() + self.batch_interval_ms / 1000
+                while self._in_flight and len(batch) < self.max_batch_size:
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), deadline - loop.time()))
+                    except asyncio.TimeoutError:
+                        break
+
+            # Counted before the task starts so the next batch already sees this one as in flight
+            self._in_flight += 1
+            task = asyncio.create_task(self._send(batch))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send(self, batch):
+        try:
+            data = b"[" + b",".join(body for body, _ in batch) + b"]"
+            async with self.client.stream("POST", self.url, content=data, headers=JSON_HEADERS) as response:
+                try:
+                    response.raise_for_status()
+                except httpx.HTTPStatusError as e:
+                    # Only the first 512 bytes of an error body are read; the rest is dropped with the stream
+                    head = await anext(response.aiter_bytes(512), b"")
+                    raise httpx.HTTPStatusError(
+                        f"{response.status_code}: {head!r}", request=e.request, response=response
+                    ) from None
+                completed = response.headers.get('X-AutoBatch-Completed')
+                results = json_loads(await response.aread())['results']
+            # A short or malformed results array must fail every caller rather than leave some unresolved
+            if not isinstance(results, list) or len(results) != len(batch):
+                raise ValueError(f"Expected {len(batch)} results, got {results!r:.200}")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._in_flight -= 1
+
+        print(f"Batch completed: {completed}/{len(batch)}")
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+def print_result(result):
+    if 'error' in result:
+        print(f"❌ Error: {result['status_code']}")
+        print(result['error'])
+        return
+
+    print("✅ Success!")
+    print("Template selected:", result.get('template_name'))
+    print("Extracted fields:")
+    for key, value in result.items():
+        if key != 'template_name':
+            print(f"  {key}: {value}")
+
+# Every case needs the running app and reachable images, so a default pytest run reports them as skipped
+pytestmark = pytest.mark.skipif(
+    os.getenv("SELECT_TEMPLATE_IT") != "1",
+    reason="integration test against a running backend_main.py; set SELECT_TEMPLATE_IT=1 to run",
+)
+
+@pytest.fixture(scope="session")
+def http_client():
+    # One pooled client per test session, i.e. per xdist worker
+    client = httpx.Client(**CLIENT_OPTIONS)
+    warm_up(client)
+    yield client
+    client.close()
+
+@pytest.fixture(scope="session")
+def reachable():
+    async def precheck():
+        async with httpx.AsyncClient(**PRECHECK_OPTIONS) as client:
+            return await reachable_urls(client, (url for payload in PAYLOADS for url in payload['image_urls']))
+    return asyncio.run(precheck())
+
+@pytest.mark.parametrize("payload", PAYLOADS, ids=[f"{len(p['image_urls'])}-images" for p in PAYLOADS])
+def test_select_template(http_client, reachable, payload):
+    # Opted in, so dead image URLs are a broken setup rather than a reason to skip
+    assert reachable.intersection(payload['image_urls']), \
+        "none of the payload's image URLs are reachable; point SELECT_TEMPLATE_IMAGE_URLS at real images"
+
+    body = b"[" + encode_payload(payload, reachable) + b"]"
+    with http_client.stream("POST", BATCH_URL, content=body, headers=JSON_HEADERS) as response:
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError:
+            # Only the first 512 bytes of an error body are read; the rest is dropped with the stream
+            pytest.fail(f"❌ {response.status_code}: {next(response.iter_bytes(512), b'')!r}")
+        result, = json_loads(response.read())['results']
+    assert 'error' not in result, result
+    assert result.get('template_name')
+
+async def run_batch():
+    async with httpx.AsyncClient(**CLIENT_OPTIONS) as client, httpx.AsyncClient(**PRECHECK_OPTIONS) as precheck_client:
+        # Drop dead image URLs up front instead of letting the server fail on them
+        reachable = await reachable_urls(
+            precheck_client, (url for payload in PAYLOADS for url in payload['image_urls'])
+        )
+        bodies = []
+        for i, payload in enumerate(PAYLOADS):
+            if not reachable.intersection(payload['image_urls']):
+                print(f"⚠️ Skipping payload {i}: none of its image URLs are reachable")
+                continue
+            bodies.append(encode_payload(payload, reachable))
+
+        await async_warm_up(client)
+        batcher = Batcher(client)
+        started = time.perf_counter()
+        try:
+            results = await asyncio.gather(*(batcher.submit(body) for body in bodies))
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"❌ Request failed: {e}")
+            return
+        finally:
+            await batcher.aclose()
+    print(f"Selected templates for {len(results)} payloads in {time.perf_counter() - started:.2f}s")
+
+    for result in results:
+        print_result(result)
 
 if __name__ == "__main__":
-    test_select_template() 
\ No newline at end of file
+    asyncio.run(run_batch())